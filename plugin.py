@@ -1,27 +1,138 @@
 import os
 import re
 import shlex
+import shutil
+import stat
 import subprocess
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import lru_cache
 
 import sublime
+import sublime_plugin
 from LSP.plugin import DottedDict
 from LSP.plugin.core.protocol import WorkspaceFolder
 from LSP.plugin.core.types import ClientConfig
-from LSP.plugin.core.typing import Any, Callable, List, Optional, Tuple, cast
+from LSP.plugin.core.typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, cast
 from lsp_utils import NpmClientHandler
 from sublime_lib import ResourcePath
 
 if int(sublime.version()) >= 4070:
     from LSP.plugin import MarkdownLangMap
 
+IS_WINDOWS = sublime.platform() == "windows"
+# the python binary relative to a venv folder
+VENV_PYTHON_BINARY = ("Scripts", "python.exe") if IS_WINDOWS else ("bin", "python")
+
 
 def plugin_loaded() -> None:
+    _cached_isdir.cache_clear()
+    _clear_venv_caches()
     LspPyrightPlugin.setup()
 
 
 def plugin_unloaded() -> None:
+    _clear_venv_caches()
     LspPyrightPlugin.cleanup()
+    # only after cleanup() so that callbacks running until then can still submit work
+    _executor.shutdown(wait=False)
+
+
+# runs blocking work (e.g. venv tool processes or stat calls) concurrently
+_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def _normalize_path(path: str) -> str:
+    # normalized and interned so that equivalent paths hit the same cache entries
+    return sys.intern(os.path.normpath(path))
+
+
+# path => os.path.isfile(path), a plain dict so that entries below a folder can be evicted
+_isfile_cache = {}  # type: Dict[str, bool]
+# workspace folder => its mtime when the folder was last resolved
+_workspace_mtimes = {}  # type: Dict[str, int]
+
+
+def _cached_isfile(path: str) -> bool:
+    result = _isfile_cache.get(path)
+    if result is None:
+        if len(_isfile_cache) >= 4096:
+            _isfile_cache.clear()
+        result = _isfile_cache[path] = os.path.isfile(path)
+    return result
+
+
+def _evict_cached_isfile(folder: str) -> None:
+    prefix = os.path.join(folder, "")
+    for path in [path for path in _isfile_cache if path.startswith(prefix)]:
+        del _isfile_cache[path]
+
+
+@lru_cache(maxsize=4096)
+def _cached_isdir(path: str) -> bool:
+    return os.path.isdir(path)
+
+
+@lru_cache(maxsize=8)
+def _which(command: str) -> Optional[str]:
+    # installing or uninstalling a tool is only noticed after the plugin is reloaded
+    return shutil.which(command)
+
+
+@lru_cache(maxsize=256)
+def _check_output_cached(command: Tuple[str, ...], cwd: str, mtime_ns: int) -> str:
+    # Exceptions are not cached by lru_cache so failing commands are re-run on the next call. Successful output is
+    # kept until the config file's mtime changes or _clear_venv_caches() runs (marker file saved, python settings
+    # changed), so e.g. "poetry env use" is only noticed after one of those.
+    if IS_WINDOWS:
+        # do not create a window for the process
+        startupinfo = subprocess.STARTUPINFO()  # type: ignore
+        startupinfo.wShowWindow = subprocess.SW_HIDE  # type: ignore
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW  # type: ignore
+    else:
+        startupinfo = None  # type: ignore
+
+    return subprocess.check_output(command, cwd=cwd, startupinfo=startupinfo, universal_newlines=True)
+
+
+def _clear_venv_caches() -> None:
+    """Clears all caches used for resolving the python path of a workspace."""
+    # note that misses are cached as well so they have to be dropped when files may have been created
+    _isfile_cache.clear()
+    _workspace_mtimes.clear()
+    _check_output_cached.cache_clear()
+    LspPyrightPlugin._resolve_python_path_from_workspace.cache_clear()
+
+
+def binary_from_python_path(path: str) -> Optional[str]:
+    binary_path = os.path.join(path, *VENV_PYTHON_BINARY)
+    return binary_path if _cached_isfile(binary_path) else None
+
+
+# Config file, venv resolution command, post-processing
+VENV_CONFIG_FILES = (
+    ("Pipfile", ("pipenv", "--py"), None),
+    ("poetry.lock", ("poetry", "env", "info", "-p"), binary_from_python_path),
+    (".python-version", ("pyenv", "which", "python"), None),
+)  # type: Tuple[Tuple[str, Tuple[str, ...], Optional[Callable[[str], Optional[str]]]], ...]
+
+# matches the Python version in paths like "python3.3" or "python38"
+PYTHON3_VERSION_RE = re.compile(r"(python3\.?)[38]", re.IGNORECASE)
+
+# conventional names of a venv folder in the project
+VENV_DIR_NAMES = frozenset((".venv", "venv", "env"))
+
+# files whose modification may change the resolved python path
+VENV_MARKER_FILES = frozenset([config_file for config_file, _, _ in VENV_CONFIG_FILES] + ["pyvenv.cfg"])
+
+
+class LspPyrightVenvListener(sublime_plugin.EventListener):
+    def on_post_save_async(self, view: sublime.View) -> None:
+        file_name = view.file_name()
+        if file_name and os.path.basename(file_name) in VENV_MARKER_FILES:
+            _clear_venv_caches()
 
 
 class LspPyrightPlugin(NpmClientHandler):
@@ -29,6 +140,11 @@ class LspPyrightPlugin(NpmClientHandler):
     server_directory = "language-server"
     server_binary_path = os.path.join(server_directory, "node_modules", "pyright", "langserver.index.js")
 
+    # the "python.*" settings seen by the last on_settings_changed() call, shared by all sessions
+    _last_python_settings = None  # type: Optional[Tuple[Any]]
+    # the inputs and result of the last find_package_dependency_dirs() call
+    _last_dependency_dirs = None  # type: Optional[Tuple[Tuple[Tuple[int, int], Tuple[str, ...]], List[str]]]
+
     @classmethod
     def minimum_node_version(cls) -> Tuple[int, int, int]:
         return (14, 0, 0)
@@ -47,8 +163,16 @@ class LspPyrightPlugin(NpmClientHandler):
 
             # add package dependencies into "python.analysis.extraPaths"
             extraPaths = settings.get("python.analysis.extraPaths") or []  # type: List[str]
-            extraPaths.extend(self.find_package_dependency_dirs(py_ver))
-            settings.set("python.analysis.extraPaths", extraPaths)
+            extraPaths.extend(self.get_package_dependency_dirs(py_ver))
+            # this may run repeatedly on the same settings so drop duplicates (preserving order)
+            settings.set("python.analysis.extraPaths", list(OrderedDict.fromkeys(extraPaths)))
+
+        # this runs on every server start, so only drop the venv caches when "python.*" settings really changed
+        python_settings = deepcopy(settings.get("python"))
+        cls = type(self)
+        if cls._last_python_settings is not None and cls._last_python_settings[0] != python_settings:
+            _clear_venv_caches()
+        cls._last_python_settings = (python_settings,)
 
     @classmethod
     def on_pre_start(
@@ -70,6 +194,7 @@ class LspPyrightPlugin(NpmClientHandler):
         src = "Packages/{}/resources/".format(cls.package_name)
         dest = os.path.join(cls.package_storage(), "resources")
         ResourcePath(src).copytree(dest, exist_ok=True)
+        _cached_isdir.cache_clear()
 
     @classmethod
     def markdown_language_id_to_st_syntax_map(cls) -> Optional["MarkdownLangMap"]:
@@ -97,25 +222,68 @@ class LspPyrightPlugin(NpmClientHandler):
     def get_plugin_setting(cls, key: str, default: Optional[Any] = None) -> Any:
         return sublime.load_settings(cls.package_name + ".sublime-settings").get(key, default)
 
-    def find_package_dependency_dirs(self, py_ver: Tuple[int, int] = (3, 3)) -> List[str]:
-        dep_dirs = sys.path.copy()
+    def get_package_dependency_dirs(self, py_ver: Tuple[int, int]) -> List[str]:
+        """Same as `find_package_dependency_dirs()` but reuses the last result if `sys.path` is unchanged."""
+        key = (py_ver, tuple(sys.path))
+        if self._last_dependency_dirs is None or self._last_dependency_dirs[0] != key:
+            self._last_dependency_dirs = (key, self.find_package_dependency_dirs(py_ver))
+        return self._last_dependency_dirs[1]
 
-        # replace paths for target Python version
-        # @see https://github.com/sublimelsp/LSP-pyright/issues/28
-        re_pattern = r"(python3\.?)[38]"
+    def find_package_dependency_dirs(self, py_ver: Tuple[int, int] = (3, 3)) -> List[str]:
         re_replacement = r"\g<1>8" if py_ver == (3, 8) else r"\g<1>3"
-        dep_dirs = [re.sub(re_pattern, re_replacement, d, flags=re.IGNORECASE) for d in dep_dirs]
+        packages_path = sublime.packages_path()
+        # checked before any lookup below populates the cache
+        is_cache_cold = _cached_isdir.cache_info().currsize == 0
+
+        # sublime stubs - add as first
+        stubs_path = os.path.join(self.package_storage(), "resources", "typings", "sublime_text")
+        dep_dirs = [stubs_path] if _cached_isdir(stubs_path) else []
+
+        candidates = []  # type: List[str]
+        for path in sys.path:
+            # replace paths for target Python version
+            # @see https://github.com/sublimelsp/LSP-pyright/issues/28
+            if "python3" in path.lower():
+                path = PYTHON3_VERSION_RE.sub(re_replacement, path)
+            if path != packages_path:
+                candidates.append(path)
+
+        # while the cache is cold, stat concurrently to hide the latency of slow (e.g. network) file systems;
+        # once warm, the lookups are cheaper than dispatching them to the executor
+        if is_cache_cold and len(candidates) > 32:
+            is_dirs = _executor.map(_cached_isdir, candidates)  # type: Iterable[bool]
+        else:
+            is_dirs = map(_cached_isdir, candidates)
+        dep_dirs.extend(path for path, is_dir in zip(candidates, is_dirs) if is_dir)
 
         # move the "Packages/" to the last
         # @see https://github.com/sublimelsp/LSP-pyright/pull/26#discussion_r520747708
-        packages_path = sublime.packages_path()
-        dep_dirs.remove(packages_path)
-        dep_dirs.append(packages_path)
+        if _cached_isdir(packages_path):
+            dep_dirs.append(packages_path)
 
-        # sublime stubs - add as first
-        dep_dirs.insert(0, os.path.join(self.package_storage(), "resources", "typings", "sublime_text"))
+        return dep_dirs
 
-        return [path for path in dep_dirs if os.path.isdir(path)]
+    @classmethod
+    def _resolve_via_tool(
+        cls, workspace_folder: str, config_file: str, command: Tuple[str, ...], mtime_ns: int
+    ) -> Optional[str]:
+        """
+        Runs the venv resolution command of a config file.
+
+        Only successful runs are cached, keyed by the config file's mtime, so a failing command is retried
+        next time, e.g. after the environment has been installed.
+        """
+        try:
+            return _check_output_cached(command, workspace_folder, mtime_ns).strip()
+        except FileNotFoundError:
+            print("{}: WARN: {} detected but {} not found".format(cls.name(), config_file, command[0]))
+        except subprocess.CalledProcessError:
+            print(
+                "{}: WARN: {} detected but {} exited with non-zero exit status".format(
+                    cls.name(), config_file, " ".join(map(shlex.quote, command))
+                )
+            )
+        return None
 
     @classmethod
     def resolve_python_path_from_venv(
@@ -127,58 +295,84 @@ class LspPyrightPlugin(NpmClientHandler):
         See https://github.com/fannheyward/coc-pyright/blob/d58a468b1d7479a1b56906e386f44b997181e307/src/configSettings.ts#L47.  # noqa: E501
         """
 
-        def binary_from_python_path(path: str) -> Optional[str]:
-            if sublime.platform() == "windows":
-                binary_path = os.path.join(path, "Scripts", "python.exe")
-            else:
-                binary_path = os.path.join(path, "bin", "python")
-
-            return binary_path if os.path.isfile(binary_path) else None
-
         python_path = settings.get("python.pythonPath")
         if python_path:
             return python_path
 
         if not workspace_folders:
             return None
-        workspace_folder = workspace_folders[0].path
-
-        # Config file, venv resolution command, post-processing
-        venv_config_files = [
-            ("Pipfile", ["pipenv", "--py"], None),
-            ("poetry.lock", ["poetry", "env", "info", "-p"], binary_from_python_path),
-            (".python-version", ["pyenv", "which", "python"], None),
-        ]  # type: List[Tuple[str, List[str], Optional[Callable[[str], Optional[str]]]]]
-
-        if sublime.platform() == "windows":
-            # do not create a window for the process
-            startupinfo = subprocess.STARTUPINFO()  # type: ignore
-            startupinfo.wShowWindow = subprocess.SW_HIDE  # type: ignore
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW  # type: ignore
+        workspace_folder = _normalize_path(workspace_folders[0].path)
+        try:
+            # Only top-level entries being added to or removed from the folder change its mtime, e.g. an in-tree venv
+            # being created. Venvs created elsewhere (pipenv/poetry default) or populated after their folder was
+            # created are only noticed once _clear_venv_caches() runs.
+            mtime_ns = os.stat(workspace_folder).st_mtime_ns
+        except OSError:
+            return None
+        if _workspace_mtimes.get(workspace_folder) != mtime_ns:
+            # e.g. a cached miss for "<entry>/pyvenv.cfg" may be stale by now
+            _evict_cached_isfile(workspace_folder)
+            _workspace_mtimes[workspace_folder] = mtime_ns
+        return cls._resolve_python_path_from_workspace(workspace_folder, mtime_ns)
+
+    @classmethod
+    @lru_cache(maxsize=32)
+    def _resolve_python_path_from_workspace(cls, workspace_folder: str, mtime_ns: int) -> Optional[str]:
+        """
+        Resolves the python binary path from files in the workspace folder.
+
+        The folder's mtime is part of the cache key so the result is recomputed when its top-level entries
+        change, e.g. when a venv is created inside of it. This does not notice environments living elsewhere.
+        """
+        # a single listing of the workspace root serves both the config file and the venv folder lookups
+        try:
+            file_names = os.listdir(workspace_folder)
+        except OSError:
+            return None
+
+        present_names = frozenset(file_names)
+
+        tool_calls = []  # type: List[Tuple[str, Tuple[str, ...], int, Optional[Callable[[str], Optional[str]]]]]
+        for config_file, command, post_processing in VENV_CONFIG_FILES:
+            if config_file not in present_names:
+                continue
+            if not _which(command[0]):
+                print("{}: WARN: {} detected but {} not found".format(cls.name(), config_file, command[0]))
+                continue
+            try:
+                config_file_stat = os.stat(workspace_folder + os.sep + config_file)
+            except OSError:
+                continue
+            if not stat.S_ISREG(config_file_stat.st_mode):
+                continue
+            tool_calls.append((config_file, command, config_file_stat.st_mtime_ns, post_processing))
+
+        if len(tool_calls) > 1:
+            # run the tools concurrently but keep the priority of VENV_CONFIG_FILES for picking the result
+            futures = [
+                _executor.submit(cls._resolve_via_tool, workspace_folder, config_file, command, mtime_ns)
+                for config_file, command, mtime_ns, _ in tool_calls
+            ]
+            results = (future.result() for future in futures)  # type: Iterable[Optional[str]]
         else:
-            startupinfo = None  # type: ignore
-
-        for config_file, command, post_processing in venv_config_files:
-            full_config_file_path = os.path.join(workspace_folder, config_file)
-            if os.path.isfile(full_config_file_path):
-                try:
-                    python_path = subprocess.check_output(
-                        command, cwd=workspace_folder, startupinfo=startupinfo, universal_newlines=True
-                    ).strip()
-                    return post_processing(python_path) if post_processing else python_path
-                except FileNotFoundError:
-                    print("{}: WARN: {} detected but {} not found".format(cls.name(), config_file, command[0]))
-                except subprocess.CalledProcessError:
-                    print(
-                        "{}: WARN: {} detected but {} exited with non-zero exit status".format(
-                            cls.name(), config_file, " ".join(map(shlex.quote, command))
-                        )
-                    )
+            results = (
+                cls._resolve_via_tool(workspace_folder, config_file, command, mtime_ns)
+                for config_file, command, mtime_ns, _ in tool_calls
+            )
+
+        for python_path, (_, _, _, post_processing) in zip(results, tool_calls):
+            if python_path is not None:
+                return post_processing(python_path) if post_processing else python_path
 
         # virtual environment as subfolder in project
-        for file in os.listdir(workspace_folder):
-            maybe_venv_path = os.path.join(workspace_folder, file)
-            if os.path.isfile(os.path.join(maybe_venv_path, "pyvenv.cfg")):
+        # try conventional venv folder names first so other entries usually don't have to be probed
+        file_names.sort(key=lambda name: name not in VENV_DIR_NAMES)
+        for file in file_names:
+            if file in VENV_MARKER_FILES:
+                # known to be files, not venv folders
+                continue
+            maybe_venv_path = workspace_folder + os.sep + file
+            if _cached_isfile(maybe_venv_path + os.sep + "pyvenv.cfg"):
                 # found a venv
                 return binary_from_python_path(maybe_venv_path)
 